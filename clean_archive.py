@@ -4,53 +4,139 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
-# Import CoastGuard
-from coast_guard import cleaners
 import argparse
-import psrchive as ps
+import multiprocessing
 import os
 
-def apply_surgical_cleaner(ar, tmp, cthresh=3.0, sthresh=3.0):
-    print("Applying the surgical cleaner")
+def load_surgical_cleaner(tmp, cthresh=3.0, sthresh=3.0):
+    # Imported here, rather than at the top, so that --help and usage
+    # errors don't pay for loading psrchive and CoastGuard
+    from coast_guard import cleaners
+
+    print("Loading the surgical cleaner")
     print("\t channel threshold = {0}".format(cthresh))
     print("\t  subint threshold = {0}".format(sthresh))
 
     surgical_cleaner = cleaners.load_cleaner('surgical')
     surgical_parameters = "chan_numpieces=1,subint_numpieces=1,chanthresh={1},subintthresh={2},template={0}".format(tmp, cthresh, sthresh)
     surgical_cleaner.parse_config_string(surgical_parameters)
+    return surgical_cleaner
+
+
+def apply_surgical_cleaner(ar, surgical_cleaner):
+    print("Applying the surgical cleaner")
     surgical_cleaner.run(ar)
 
-    
 
-if __name__ == "__main__":
-    # Parse some arguments to set up cleaning
-    parser = argparse.ArgumentParser(description="Run MeerGuard on input archive file")
-    parser.add_argument("-a", "--archive", type=str, dest="archive_path", help="Path to the archive file")
-    parser.add_argument("-T", "--template", type=str, dest="template_path", help="Path to the 2D template file")
-    parser.add_argument("-c", "--chanthresh", type=float, dest="chan_thresh", help="Channel threshold (in sigma) [default = 3.0]", default=3.0)
-    parser.add_argument("-s", "--subthresh", type=float, dest="subint_thresh", help="Subint threshold (in sigma) [default = 3.0]", default=3.0)
-    parser.add_argument("-o", "--outname", type=str, dest="output_name", help="Output archive name", default=None)
-    parser.add_argument("-O", "--outpath", type=str, dest="output_path", help="Output path [default = CWD]", default=os.getcwd())
-    args = parser.parse_args()
+def get_archive_paths(args):
+    archive_paths = []
+    if args.archive_paths is not None:
+        archive_paths.extend(args.archive_paths)
+    if args.archive_list is not None:
+        with open(args.archive_list) as ff:
+            for line in ff:
+                line = line.split('#')[0].strip()
+                if line:
+                    archive_paths.append(line)
+    return archive_paths
 
 
-    # Load an Archive file
-    loaded_archive = ps.Archive_load(args.archive_path)
-    archive_path, archive_name = os.path.split(loaded_archive.get_filename())
+def get_output_name(archive_path, args):
+    if args.output_name is not None:
+        return args.output_name
+    archive_name = os.path.basename(archive_path)
     archive_name_pref = archive_name.split('.')[0]
-    archive_name_suff = "".join(archive_name.split('.')[1:])
     #psrname = archive_name_orig.split('_')[0]
 
     # Renaming archive file with statistical thresholds
-    if args.output_name is None:
-        out_name = "{0}_ch{1}_sub{2}.ar".format(archive_name_pref, args.chan_thresh, args.subint_thresh, archive_name_suff)
-    else:
-        out_name = args.output_name
+    return "{0}_ch{1}_sub{2}.ar".format(archive_name_pref, args.chan_thresh, args.subint_thresh)
 
 
-    apply_surgical_cleaner(loaded_archive, args.template_path, cthresh=args.chan_thresh, sthresh=args.subint_thresh)
+def clean_archive(archive_path, out_name, surgical_cleaner, args):
+    import psrchive as ps
+
+    # Load an Archive file
+    loaded_archive = ps.Archive_load(str(archive_path))
+
+    apply_surgical_cleaner(loaded_archive, surgical_cleaner)
 
     # Unload the Archive file
     print("Unloading the cleaned archive: {0}".format(out_name))
     loaded_archive.unload(str(out_name))  # need to typecast to str here because otherwise Python converts to a unicode string which the PSRCHIVE library can't parse
 
+
+def _clean_one(paths):
+    # Worker for the process pool. 'surgical_cleaner' and 'args' are
+    # set up in the parent and inherited when the workers are forked.
+    archive_path, out_name = paths
+    clean_archive(archive_path, out_name, surgical_cleaner, args)
+
+
+if __name__ == "__main__":
+    # Parse some arguments to set up cleaning
+    parser = argparse.ArgumentParser(description="Run MeerGuard on input archive file(s)")
+    parser.add_argument("-a", "--archive", type=str, nargs='+', dest="archive_paths", help="Path(s) to the archive file(s)", default=None)
+    parser.add_argument("-A", "--archive-list", type=str, dest="archive_list", help="File listing archives to clean, one per line", default=None)
+    parser.add_argument("-T", "--template", type=str, dest="template_path", help="Path to the 2D template file")
+    parser.add_argument("-c", "--chanthresh", type=float, dest="chan_thresh", help="Channel threshold (in sigma) [default = 3.0]", default=3.0)
+    parser.add_argument("-s", "--subthresh", type=float, dest="subint_thresh", help="Subint threshold (in sigma) [default = 3.0]", default=3.0)
+    parser.add_argument("-o", "--outname", type=str, dest="output_name", help="Output archive name (only with a single archive)", default=None)
+    parser.add_argument("-O", "--outpath", type=str, dest="output_path", help="Output path [default = CWD]", default=os.getcwd())
+    parser.add_argument("-j", "--nproc", type=int, dest="nproc", help="Number of archives to clean in parallel (0 = one per CPU) [default = 1]", default=1)
+    args = parser.parse_args()
+
+    if args.nproc < 0:
+        parser.error("-j/--nproc must be 0 (one per CPU) or more")
+    archive_paths = get_archive_paths(args)
+    if not archive_paths:
+        parser.error("No archives provided (use -a/--archive or -A/--archive-list)")
+    if args.output_name is not None and len(archive_paths) > 1:
+        parser.error("-o/--outname can only be used when cleaning a single archive")
+    # Work out every output name up front so that no cleaned archive
+    # silently overwrites another (e.g. a/obs.ar and b/obs.ar, or
+    # obs.0001.ar and obs.0002.ar)
+    out_names = [get_output_name(archive_path, args) for archive_path in archive_paths]
+    seen, duplicates = set(), set()
+    for out_name in out_names:
+        if out_name in seen:
+            duplicates.add(out_name)
+        seen.add(out_name)
+    if duplicates:
+        parser.error("Several archives would be written to the same output file: {0}".format(", ".join(sorted(duplicates))))
+
+    nproc = args.nproc if args.nproc > 0 else multiprocessing.cpu_count()
+    nproc = min(nproc, len(archive_paths))
+    if nproc > 1:
+        # Each worker cleans one archive at a time, so don't let
+        # numerical libraries (or numba's parallel kernels) spawn
+        # threads of their own. These must be set before numpy,
+        # numba and psrchive are imported to take effect.
+        os.environ['OMP_NUM_THREADS'] = '1'
+        os.environ['NUMBA_NUM_THREADS'] = '1'
+
+    # The cleaner is set up once and re-used for every archive. Its
+    # template is processed when it's first needed, then cached in
+    # that process.
+    surgical_cleaner = load_surgical_cleaner(args.template_path, cthresh=args.chan_thresh, sthresh=args.subint_thresh)
+    if nproc > 1:
+        # The workers are forked with a copy of the parent's cleaner.
+        # Each one processes the template once, on its first archive.
+        pool = multiprocessing.Pool(nproc)
+        finished = False
+        try:
+            # Archives are handed out one at a time as workers free up,
+            # and a failure is raised as soon as it happens rather
+            # than after every archive has been cleaned
+            for _ in pool.imap_unordered(_clean_one, zip(archive_paths, out_names), chunksize=1):
+                pass
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+            else:
+                # Don't wait for the queued archives on failure
+                pool.terminate()
+            pool.join()
+    else:
+        for archive_path, out_name in zip(archive_paths, out_names):
+            clean_archive(archive_path, out_name, surgical_cleaner, args)
@@ -9,10 +9,10 @@ import optparse
 import sys
 import types
 import re
-import shutil
 import os
 import tempfile
 import argparse
+import multiprocessing
 import warnings
 
 import numpy as np
@@ -517,7 +517,7 @@ def clean_archive(inarf, outfn, clean_re=None, *args, **kwargs):
         clean_re = config.cfg.clean_strategy
     try:
         outfn = utils.get_outfn(outfn, inarf)
-        shutil.copy(inarf.fn, outfn)
+        utils.copy_file(inarf.fn, outfn)
         
         outarf = utils.ArchiveFile(outfn)
  
@@ -548,6 +548,90 @@ def clean_archive(inarf, outfn, clean_re=None, *args, **kwargs):
     return outarf
 
 
+# Cleaners are only set up once for each distinct configuration.
+# Their default parameters can depend on the archive's configs,
+# so the defaults are part of the key.
+cleaner_cache = {}
+
+
+def get_cleaner(name, cfgstrs):
+    """Return a cleaner configured with the given strings,
+        re-using a previously configured one if possible.
+
+        Inputs:
+            name: The name of the cleaner.
+            cfgstrs: A list of configuration strings to apply.
+
+        Output:
+            cleaner: The configured cleaner instance.
+    """
+    key = (name, tuple(cfgstrs), \
+            getattr(config.cfg, "%s_default_params" % name))
+    if key not in cleaner_cache:
+        # Set up the cleaner
+        cleaner = cleaners.load_cleaner(name)
+        for cfgstr in cfgstrs:
+            cleaner.parse_config_string(cfgstr)
+        cleaner_cache[key] = cleaner
+    return cleaner_cache[key]
+
+
+def clean_file(infn):
+    """Clean a single archive with the queued cleaners, and
+        write the result to the output file.
+
+        Input:
+            infn: The name of the archive to clean.
+
+        Outputs:
+            None
+    """
+    inarf = utils.ArchiveFile(infn)
+    config.cfg.load_configs_for_archive(inarf)
+    outfn = utils.get_outfn(args.outfn, inarf)
+    if os.path.exists(outfn) and os.path.samefile(outfn, inarf.fn):
+        raise errors.CleanError("Output file name (%s) is the same as " \
+                                "the input file's!" % outfn)
+    # The input archive is cleaned in memory and written straight
+    # to the output file, so there's no need to copy the input first
+    ar = inarf.get_archive()
+    
+    try:
+        for name, cfgstrs in args.cleaner_queue:
+            get_cleaner(name, cfgstrs).run(ar)
+    finally:
+        # Write out the archive even if a cleaner failed, so
+        # whatever cleaning was done isn't lost
+        ar.unload(outfn)
+        print "Cleaned archive: %s" % outfn
+
+
+def init_worker():
+    """Set up a worker process for cleaning archives in parallel.
+        Each worker cleans one archive at a time, so numba's
+        parallel kernels are limited to a single thread, rather
+        than every worker starting a thread per CPU.
+
+        Inputs:
+            None
+
+        Outputs:
+            None
+    """
+    if clean_utils.numba is not None:
+        # numba reads NUMBA_NUM_THREADS when it is imported, so it's
+        # too late to set it in the environment here. Its thread pool
+        # isn't launched until the first parallel kernel runs though.
+        # This pokes at numba internals, so if they're not what's
+        # expected just leave numba's thread count alone. (An error
+        # here would make the pool respawn dead workers forever.)
+        try:
+            from numba.npyufunc import parallel
+            parallel.NUM_THREADS = 1
+        except (ImportError, AttributeError):
+            pass
+
+
 def main():
     print ""
     print "         clean.py"
@@ -558,33 +642,29 @@ def main():
     to_clean = utils.exclude_files(file_list, to_exclude)
     print "Number of input files: %d" % len(to_clean)
     
-    
-    # Read configurations
-    for infn in to_clean:
-        inarf = utils.ArchiveFile(infn)
-        config.cfg.load_configs_for_archive(inarf)
-        outfn = utils.get_outfn(args.outfn, inarf)
-        shutil.copy(inarf.fn, outfn)
-        
-        outarf = utils.ArchiveFile(outfn)
-        ar = outarf.get_archive()
-        
+    nproc = args.nproc if args.nproc > 0 else multiprocessing.cpu_count()
+    nproc = min(nproc, len(to_clean))
+    if nproc > 1:
+        # Archives are independent, so clean them in separate
+        # processes. Each worker keeps its own cleaners and configs.
+        pool = multiprocessing.Pool(processes=nproc, \
+                                    initializer=init_worker)
+        finished = False
         try:
-            for name, cfgstrs in args.cleaner_queue:
-                # Set up the cleaner
-                cleaner = cleaners.load_cleaner(name)
-                for cfgstr in cfgstrs:
-                    cleaner.parse_config_string(cfgstr)
-                cleaner.run(ar)
-        except:
-            # An error prevented cleaning from being successful
-            # Remove the output file because it may confuse the user
-            #if os.path.exists(outfn):
-            #    os.remove(outfn)
-            raise
+            for _ in pool.imap_unordered(clean_file, to_clean, chunksize=1):
+                pass
+            finished = True
         finally:
-            ar.unload(outfn)
-            print "Cleaned archive: %s" % outfn
+            if finished:
+                pool.close()
+            else:
+                # Report a failure straight away, rather than
+                # after the remaining files have been cleaned
+                pool.terminate()
+            pool.join()
+    else:
+        for infn in to_clean:
+            clean_file(infn)
         
     
 class CleanerArguments(utils.DefaultArguments):
@@ -650,9 +730,15 @@ if __name__=="__main__":
                         help="A string of Cleaner configurations to " \
                             "apply to the cleaner most recently added " \
                             "to the queue.")
+    parser.add_argument('-j', '--nproc', dest='nproc', type=int, \
+                        default=1, \
+                        help="Number of archives to clean in parallel " \
+                            "(0 = one per CPU). (Default: 1)")
     parser.add_argument('--list-cleaners', nargs=0, \
                         action=parser.ListCleanersAction, \
                         help="List available cleaners and descriptions, then exit.")
     args = parser.parse_args()
+    if args.nproc < 0:
+        parser.error("-j/--nproc must be 0 (one per CPU) or more")
 
     main()
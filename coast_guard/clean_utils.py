@@ -4,11 +4,15 @@ Useful utility functions for cleaning a PSRCHIVE archive.
 Patrick Lazarus, Feb. 14, 2012
 """
 import warnings
-import multiprocessing
 
 import numpy as np
 import scipy.stats
 import scipy.optimize
+try:
+    import numba
+except ImportError:
+    # numba is optional, pure numpy versions are used without it
+    numba = None
 
 import utils
 import config
@@ -16,29 +20,10 @@ import errors
 
 # takes an archive and determines fractional zapping for each frequency channel
 def freq_fraczap(ar):
-    
-
-
-    weights=np.bitwise_not(np.expand_dims(ar.get_weights(),2).astype(bool))
-    
-
-    nsub, nchan,nbool = np.shape(weights)
-    
-
-    weights = 1*weights    
-    freqs=get_frequencies(ar)
-    counts=np.sum(weights,axis=0).astype(float)/(1.*nsub)
-
-    
-    out=[]
-
-    for i in np.arange(nchan):
-        out.append([freqs[i],counts[i][0]])
-        #val=[freqs[i],counts[i][0]]
-        #out[i][0],out[i][1]=freqs[i],counts[i][0]
-        #print out[i]
-    
-    return out
+    # Fraction of subints zapped (zero-weighted) in each channel
+    counts = np.mean(ar.get_weights() == 0, axis=0)
+    freqs = get_frequencies(ar)
+    return [[freq, count] for freq, count in zip(freqs, counts)]
 
 def get_subint_weights(ar):
     return ar.get_weights().sum(axis=1)
@@ -299,12 +284,13 @@ def scale_subints(data, kernel_size=5, subintweights=None):
         subintweights = np.ones(len(data), dtype=bool)
     else:
         subintweights = np.asarray(subintweights).astype(bool)
+    halfwidth = int(kernel_size)//2
     for ii in range(len(data)):
-        lobin = ii-int(kernel_size/2)
+        lobin = ii-halfwidth
         if lobin < 0:
             lobin=None
 
-        hibin = ii+int(kernel_size/2)+1
+        hibin = ii+halfwidth+1
         if hibin > len(data):
             hibin=None
         neighbours = np.asarray(data[lobin:hibin])
@@ -348,9 +334,10 @@ def get_chan_stats(ar):
 
 def get_chans(ar, remove_prof=False, use_weights=True):
     clone = ar.clone()
+    # Scrunch polarisations first so the rest only works on total intensity
+    clone.pscrunch()
     clone.remove_baseline()
     clone.dedisperse()
-    clone.pscrunch()
     #clone.tscrunch()
     data = clone.get_data().squeeze()
     if use_weights:
@@ -364,19 +351,17 @@ def get_chans(ar, remove_prof=False, use_weights=True):
 
 
 def get_frequencies(ar):
-    integ = ar.get_first_Integration()
-    nchan = ar.get_nchan()
-    freqs = np.empty(nchan)
-    for ichan in xrange(nchan):
-        freqs[ichan] = integ.get_Profile(0, ichan).get_centre_frequency()
-    return freqs
+    # Centre frequencies of the first sub-int's channels. psrchive
+    # builds the whole array in C++, rather than a profile at a time.
+    return np.asarray(ar.get_frequencies(), dtype=float)
 
 def get_subints(ar, remove_prof=False, use_weights=True):
     clone = ar.clone()
+    # Scrunch polarisations first so the rest only works on total intensity
+    clone.pscrunch()
     clone.remove_baseline()
     clone.set_dispersion_measure(0)
     clone.dedisperse()
-    clone.pscrunch()
     #clone.fscrunch()
     data = clone.get_data().squeeze()
     if use_weights:
@@ -401,15 +386,41 @@ def fft_rotate(data, bins):
         rotation is done in the Fourier domain using the Shift Theorem.
 
         Inputs:
-            data: A 1-D numpy array to rotate.
+            data: A numpy array to rotate. If the array has more
+                than one dimension each profile along the last
+                axis is rotated.
             bins: The (possibly fractional) number of bins to rotate by.
 
         Outputs:
             rotated: The rotated data.
     """
-    freqs = np.arange(data.size/2+1, dtype=np.float)
-    phasor = np.exp(complex(0.0, 2.0*np.pi) * freqs * bins / float(data.size))
-    return np.fft.irfft(phasor*np.fft.rfft(data))
+    nbin = data.shape[-1]
+    freqs = np.arange(nbin//2+1, dtype=np.float)
+    phasor = np.exp(complex(0.0, 2.0*np.pi) * freqs * bins / float(nbin))
+    return np.fft.irfft(phasor*np.fft.rfft(data, axis=-1), n=nbin, axis=-1)
+
+
+def fft_phase_offset(prof, template):
+    """Return the number of bins 'template' must be rotated to
+        the left (see 'fft_rotate') to best line up with 'prof'.
+        The offset is the peak of the circular cross-correlation,
+        which is computed in the Fourier domain.
+
+        Inputs:
+            prof: A 1-D numpy array.
+            template: A 1-D numpy array with the same number of
+                bins as 'prof'.
+
+        Output:
+            offset: The integer offset (in bins) in the range
+                [-nbin//2, nbin//2).
+    """
+    nbin = prof.size
+    corr = np.fft.irfft(np.fft.rfft(template)*np.conj(np.fft.rfft(prof)), n=nbin)
+    offset = int(np.argmax(corr))
+    if offset >= nbin//2:
+        offset -= nbin
+    return offset
 
 
 def fit_template(prof, template):
@@ -447,25 +458,24 @@ def remove_profile1d(prof, isub, ichan, template, phs, return_params=False):
         else:
             return (isub, ichan), err(params)
 
-def remove_profile(data, nsubs, nchans, template, nthreads=None):
-    if nthreads is None:
-        nthreads = config.cfg.nthreads
-    if nthreads == 1:
-        for isub, ichan in np.ndindex(nsubs, nchans):
-            data[isub, ichan] = remove_profile1d(data[isub, ichan], \
-                                            isub, ichan, template)[1]
-    else:
-        pool = multiprocessing.Pool(processes=nthreads)
-        results = []
-        for isub, ichan in np.ndindex(nsubs, nchans):
-            results.append(pool.apply_async(remove_profile1d, \
-                            args=(data[isub, ichan], isub, ichan, template)))
-        pool.close()
-        pool.join()
-        for result in results:
-            result.successful()
-            (isub, ichan), prof = result.get()
-            data[isub, ichan] = prof
+def remove_profile(data, nsubs, nchans, template):
+    """Remove a scaled and offset copy of 'template' from every
+        (subint, channel) profile in 'data'.
+
+        The template statistics are only computed once and
+        shared by all profiles (see 'remove_scaled_template').
+
+        Inputs:
+            data: A (nsubs x nchans x nbin) array of profiles.
+            nsubs: The number of subints in 'data'.
+            nchans: The number of channels in 'data'.
+            template: The template profile (1-D).
+
+        Output:
+            data: The profile residuals. 'data' is modified in-place.
+    """
+    resids = remove_scaled_template(data.reshape((nsubs, nchans, -1)), template)
+    data[:] = resids.reshape(data.shape)
     return data
 
 
@@ -482,45 +492,92 @@ def remove_profile1d_inplace(prof, isub, ichan, template):
         return (isub, ichan), err(params)
 
 
-def remove_profile_inplace(ar, template, phs, nthreads=1):
+def remove_scaled_template(data, template):
+    """Fit a scaled and offset template to every profile in 'data'
+        and return the residuals.
+
+        The amplitude and baseline minimising
+        sum((amp*template + base - prof)**2) have a closed-form
+        (linear least-squares) solution, so all profiles are fit
+        at once with array operations rather than one 'leastsq'
+        call per profile.
+
+        Inputs:
+            data: An array of profiles with phase bins along the
+                last axis (e.g. nsub x nchan x nbin).
+            template: The template. Either 1-D (nbin), or 2-D
+                (nchan x nbin) with one template per channel.
+
+        Output:
+            resids: An array of amp*template + base - prof, with the
+                same shape as 'data'.
+    """
+    # Work at the data's precision (psrchive gives float32) so the
+    # template doesn't upcast the residual cube to float64
+    if np.issubdtype(data.dtype, np.floating):
+        template = np.asarray(template, dtype=data.dtype)
+
+    # Template statistics are computed once and broadcast
+    # against all profiles
+    tmean = template.mean(axis=-1)
+    tdev = template - tmean[..., np.newaxis]
+    tssd = np.atleast_1d(np.sum(tdev**2, axis=-1))
+    # A flat template (e.g. a zapped channel) can't be scaled
+    tssd[tssd == 0] = np.inf
+
+    if (numba is not None) and (data.ndim == 3):
+        nsub, nchan, nbin = data.shape
+        resids = np.empty_like(data)
+        _scaled_template_resids(data, \
+                    np.ascontiguousarray(np.broadcast_to(tdev, (nchan, nbin))), \
+                    np.ascontiguousarray(np.broadcast_to(tmean, (nchan,))), \
+                    np.ascontiguousarray(np.broadcast_to(tssd, (nchan,))), \
+                    resids)
+        return resids
+
+    pmean = data.mean(axis=-1)
+    # 'tdev' has zero mean, so profiles don't need to be centred
+    cov = np.einsum('...j,...j->...', data, tdev)
+    amp = cov/tssd
+    base = pmean - amp*tmean
+    return amp[..., np.newaxis]*template + base[..., np.newaxis] - data
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _scaled_template_resids(data, tdev, tmean, tssd, resids):
+        """Compiled version of 'remove_scaled_template' for
+            (nsub x nchan x nbin) data. Each profile is fit and
+            subtracted in a single pass over its bins, and subints
+            are processed in parallel. 'tdev', 'tmean' and 'tssd'
+            are the per-channel template deviations, means and sums
+            of squared deviations. Residuals are written to 'resids'.
+        """
+        nsub, nchan, nbin = data.shape
+        for isub in numba.prange(nsub):
+            for ichan in range(nchan):
+                psum = 0.0
+                cov = 0.0
+                for ibin in range(nbin):
+                    psum += data[isub, ichan, ibin]
+                    cov += data[isub, ichan, ibin]*tdev[ichan, ibin]
+                amp = cov/tssd[ichan]
+                base = psum/nbin - amp*tmean[ichan]
+                for ibin in range(nbin):
+                    resids[isub, ichan, ibin] = amp*(tdev[ichan, ibin]+tmean[ichan]) + \
+                                                    base - data[isub, ichan, ibin]
+
+
+def remove_profile_inplace(ar, template, phs):
     data = ar.get_data()[:,0,:,:] # Select first polarization channel
                                   # archive is P-scrunched, so this is
                                   # total intensity, the only polarization
                                   # channel
-    if nthreads is None:
-        nthreads = config.cfg.nthreads
-    if nthreads == 1:
-        for isub, ichan in np.ndindex(ar.get_nsubint(), ar.get_nchan()):
-            if len(np.shape(template)) > 1:  # multiple frequencies, take ichan slice
-                itemplate = template[ichan, :]  # assuming template is (nchan x nbin)
-            else:
-                itemplate = template                
-            amps = remove_profile1d(data[isub, ichan], isub, ichan, itemplate, phs)[1]
-            prof = ar.get_Profile(isub, 0, ichan)
-            if amps is None:
-                prof.set_weight(0)
-            else:
-                prof.get_amps()[:] = amps
-    else:
-        pool = multiprocessing.Pool(processes=nthreads)
-        results = []
-        for isub, ichan in np.ndindex(ar.get_nsubint(), ar.get_nchan()):
-            if len(np.shape(template)) > 1:  # multiple frequencies, find closest
-                itemplate = template[ichan, :]  # assuming template is (nsubint x nchan)
-            else:
-                itemplate = template
-            results.append(pool.apply_async(remove_profile1d, \
-                            args=(data[isub, ichan], isub, ichan, itemplate, phs)))
-        pool.close()
-        pool.join()
-        for result in results:
-            result.successful()
-            (isub, ichan), amps = result.get()
-            prof = ar.get_Profile(isub, 0, ichan)
-            if amps is None:
-                prof.set_weight(0)
-            else:
-                prof.get_amps()[:] = amps
+    # A 2-D template is (nchan x nbin), so rotating along the last
+    # axis rotates each channel's template
+    resids = remove_scaled_template(data, fft_rotate(template, phs))
+    for isub, ichan in np.ndindex(ar.get_nsubint(), ar.get_nchan()):
+        ar.get_Profile(isub, 0, ichan).get_amps()[:] = resids[isub, ichan]
 
 
 def zero_weight_subint(ar, isub):
@@ -577,9 +634,7 @@ def clean_subint(ar, isub, bins):
                 masked_data = np.ma.array(data, mask=mask)
                 std = masked_data.std()
                 mean = masked_data.mean()
-                noise = scipy.stats.norm.rvs(loc=mean, scale=std, size=len(bins))
-                for ii, newval in zip(bins, noise):
-                    data[ii] = newval
+                data[bins] = scipy.stats.norm.rvs(loc=mean, scale=std, size=len(bins))
 
 
 def get_hot_bins(data, normstat_thresh=6.3, max_num_hot=None, \
@@ -655,8 +710,9 @@ def write_psrsh_script(arf, outfn=None):
              "",
              "# Run with psrsh -e <ext> <script.psh> <archive.ar>",
              ""]
+    ar = arf.get_archive()
     # First write zapped channels
-    zapped_chans = (get_chan_weights(arf.get_archive())==0)
+    zapped_chans = (get_chan_weights(ar)==0)
     ma = np.ma.array(zapped_chans, mask=~zapped_chans)
     if any(zapped_chans):
         line = "zap chan "
@@ -671,7 +727,7 @@ def write_psrsh_script(arf, outfn=None):
                 raise ValueError("Interval start (%d) > end (%d)" % (lo, hi))
         lines.append(line)
     # Now write zapped subints
-    zapped_ints = (get_subint_weights(arf.get_archive())==0)
+    zapped_ints = (get_subint_weights(ar)==0)
     ma = np.ma.array(zapped_ints, mask=~zapped_ints)
     if any(zapped_ints):
         line = "zap subint "
@@ -686,7 +742,7 @@ def write_psrsh_script(arf, outfn=None):
                 raise ValueError("Interval start (%d) > end (%d)" % (lo, hi))
         lines.append(line)
     # Now write zapped pairs
-    zapped = arf.get_archive().get_weights()==0
+    zapped = ar.get_weights()==0
     nsub, nchan = zapped.shape
     npairs = 0
     line = "zap such "
@@ -73,16 +73,13 @@ class ReceiverBandCleaner(cleaners.BaseCleaner):
             lofreq, hifreq = self.configs.response
             # Use absolute value in case band is flipped (BW<0)
             # bw = ar.get_bandwidth()  # assigned but never used
-            nchan = ar.get_nchan()
             # chanbw = bw/nchan  # assigned but never used
             utils.print_info('Pruning frequency band to (%g-%g MHz)' % (lofreq, hifreq), 2)
-            # Loop over channels
-            for ichan in range(nchan):
-                # Get profile for subint=0, pol=0
-                prof = ar.get_Profile(0, 0, ichan)
-                freq = prof.get_centre_frequency()
-                if (freq < lofreq) or (freq > hifreq):
-                    clean_utils.zero_weight_chan(ar, ichan)
+            # Centre frequencies of each channel in the first subint
+            freqs = clean_utils.get_frequencies(ar)
+            outside = (freqs < lofreq) | (freqs > hifreq)
+            for ichan in np.flatnonzero(outside):
+                clean_utils.zero_weight_chan(ar, ichan)
 
 
     def __trim_edge_channels(self, ar):
@@ -1,5 +1,10 @@
+import os
+import hashlib
+import warnings
+
 import numpy as np
 from coast_guard import config
+from coast_guard import errors
 from coast_guard import cleaners
 from coast_guard import clean_utils
 from coast_guard.cleaners import config_types
@@ -13,6 +18,13 @@ import psrchive
 # For Daniel's debugging..
 plot_diagnostic = False
 
+# Processed templates, keyed by (cache version, filename, mtime,
+# size, nchan of data)
+template_cache = {}
+# Bump this whenever the way templates are processed changes, so
+# templates cached on disk by older versions aren't re-used
+TEMPLATE_CACHE_VERSION = 1
+
 class SurgicalScrubCleaner(cleaners.BaseCleaner):
     name = 'surgical'
     description = 'De-weight profiles that stand out compared to others ' \
@@ -90,27 +102,17 @@ class SurgicalScrubCleaner(cleaners.BaseCleaner):
 
         # Remove profile from dedispersed data
         patient.dedisperse()
-        data = patient.get_data().squeeze()
+        # Get data (select first polarization - recall we already P-scrunched)
+        data = np.ascontiguousarray(patient.get_data()[:,0,:,:], dtype=np.float32)
+        weights = patient.get_weights()
         print('Loading template')
         if self.configs.template is None:
             template = np.apply_over_axes(np.sum, data, (0, 1)).squeeze()
         else:
-            template_ar = psrchive.Archive_load(self.configs.template)
-            template_ar.pscrunch()
-            template_ar.remove_baseline()
-            template_ar.dedisperse()
-            if len(template_ar.get_frequencies()) > 1 and len(template_ar.get_frequencies()) < len(patient.get_frequencies()):
-                print("Template channel number doesn't match data... f-scrunching!")
-                template_ar.fscrunch()
-            template_ar.remove_baseline()
-            template = np.apply_over_axes(np.sum, template_ar.get_data(), (0, 1)).squeeze()
-            # make sure template is 1D
-            if len(np.shape(template)) > 1:  # sum over frequencies too
-                template_ar.fscrunch()  
+            template, template_phs = \
+                    self._get_template(len(patient.get_frequencies()))
+            if len(np.shape(template)) > 1:
                 print("2D template found. Assuming it has same frequency coverage and channels as data!")
-                template_phs = np.apply_over_axes(np.sum, template_ar.get_data(), (0, 1)).squeeze()
-            else:
-                template_phs = template
 
         print('Estimating template and profile phase offset')
         if self.configs.template is None:
@@ -127,42 +129,27 @@ class SurgicalScrubCleaner(cleaners.BaseCleaner):
                 print('template and profile have different numbers of phase bins')
             err = (lambda (amp, phs, base): amp*clean_utils.fft_rotate(template_phs, phs) +base - profile)
             amp_guess = max(profile)-min(profile) - max(template_phs)
-            phase_guess = - np.argmax(profile) + np.argmax(template_phs)
+            phase_guess = clean_utils.fft_phase_offset(profile, template_phs)
             params, status = leastsq(err, [amp_guess, phase_guess, min(profile)])
             phs = params[1]
             print('Template phase offset = {0}'.format(round(phs, 3)))
 
         print('Removing profile from patient')
-        preop_patient = patient.clone()
-        preop_patient.remove_baseline()
-        preop_weights = preop_patient.get_weights()
-
-        clean_utils.remove_profile_inplace(patient, template, phs)
-       
-        print('Accessing weights and applying to patient')
-        # re-set DM to 0
-        # patient.dededisperse()
+        if plot_diagnostic:
+            preop_data = clean_utils.apply_weights(data.copy(), weights)
+        # The residuals are all that's needed from here on, so they
+        # aren't written back into the patient archive
+        data = clean_utils.remove_scaled_template(data, \
+                                    clean_utils.fft_rotate(template, phs))
 
-        # Get weights
-        weights = patient.get_weights()
-        # Get data (select first polarization - recall we already P-scrunched)
-        data = patient.get_data()[:,0,:,:]
-        preop_data = preop_patient.get_data()[:,0,:,:]
-        data = clean_utils.apply_weights(data, weights)
-        preop_data = clean_utils.apply_weights(preop_data, weights)
-        
-        # Mask profiles where weight is 0
-        mask_2d = np.bitwise_not(np.expand_dims(weights, 2).astype(bool))
-        mask_3d = mask_2d.repeat(ar.get_nbin(), axis=2)
-        data = np.ma.masked_array(data, mask=mask_3d)
-        preop_data = np.ma.masked_array(preop_data, mask=mask_3d)        
+        print('Applying weights to patient')
+        data *= weights[:,:,np.newaxis]
  
         print('Masking on-pulse region as determined from template')
         # consider residual only in off-pulse region
         if len(np.shape(template)) > 1:  # sum over frequencies
             print('Estimating on-pulse region by f-scrunching 2D template')
-            template_ar.fscrunch()
-            template_1D = np.apply_over_axes(np.sum, template_ar.get_data(), (0, 1)).squeeze()
+            template_1D = template_phs
         else:
             template_1D = template
         # Rotate template by apropriate amount
@@ -181,11 +168,11 @@ class SurgicalScrubCleaner(cleaners.BaseCleaner):
             plt.plot(params[0]*template_rot + params[1], alpha=0.8)
             plt.plot(params[0]*masked_template + params[1], color='k', alpha=1)
         
-        # Loop through chans and subints to mask on-pulse phase bins
-        for ii in range(0, np.shape(data)[0]):
-            for jj in range(0, np.shape(data)[1]):
-                  data.mask[ii, jj, :] = masked_template.mask
-        data = np.ma.masked_array(data, mask=data.mask)
+        # Mask on-pulse phase bins in all chans and subints. Profiles
+        # with zero weight have already been zeroed above.
+        mask_3d = np.empty(data.shape, dtype=bool)
+        mask_3d[:] = np.ma.getmaskarray(masked_template)
+        data = np.ma.masked_array(data, mask=mask_3d)
         
         if plot_diagnostic:
             plt.plot(np.apply_over_axes(np.ma.sum, data, (0, 1)).squeeze(), alpha=0.8)
@@ -216,7 +203,91 @@ class SurgicalScrubCleaner(cleaners.BaseCleaner):
             # not the clone we've been working with.
             integ = ar.get_Integration(int(isub))
             integ.set_weight(int(ichan), 0.0)
-        
-        freq_fraczap = clean_utils.freq_fraczap(ar)
+
+    def _get_template(self, nchan):
+        """Return the processed template, re-using a cached copy
+            if the template file hasn't changed since it was cached.
+
+            Templates are cached in memory and, if 'template_cache_dir'
+            is set in the configurations, on disk. The cache key
+            includes TEMPLATE_CACHE_VERSION, the template file's
+            path, mtime and size, and the number of channels, which
+            is everything _process_template() depends on.
+
+            Input:
+                nchan: The number of channels in the data being cleaned.
+
+            Outputs:
+                template: The template profile(s). 1D, or 2D (nchan, nbin)
+                    if the template has as many channels as the data.
+                template_phs: The frequency-scrunched template (1D).
+        """
+        fn = os.path.abspath(self.configs.template)
+        st = os.stat(fn)
+        key = (TEMPLATE_CACHE_VERSION, fn, st.st_mtime, st.st_size, nchan)
+        if key in template_cache:
+            return template_cache[key]
+
+        cachefn = None
+        if config.cfg.template_cache_dir is not None:
+            cachedir = os.path.expanduser(config.cfg.template_cache_dir)
+            cachefn = os.path.join(cachedir, "%s.npz" % \
+                                   hashlib.sha1(repr(key)).hexdigest())
+        template = None
+        if cachefn is not None and os.path.isfile(cachefn):
+            try:
+                with np.load(cachefn) as cached:
+                    template = cached['template']
+                    template_phs = cached['template_phs']
+            except Exception, exc:
+                # A corrupt or out-of-date cache file shouldn't stop
+                # cleaning. Re-process the template (and re-cache it).
+                warnings.warn("Could not load cached template (%s): %s" % \
+                              (cachefn, str(exc)), errors.CoastGuardWarning)
+                template = None
+        if template is None:
+            template, template_phs = self._process_template(fn, nchan)
+            if cachefn is not None:
+                try:
+                    utils.ensure_dir(cachedir)
+                    # Write to a temporary file first so other processes
+                    # never see a partially written cache file
+                    tmpfn = "%s.%d.tmp" % (cachefn, os.getpid())
+                    with open(tmpfn, 'wb') as ff:
+                        np.savez(ff, template=template, template_phs=template_phs)
+                    os.rename(tmpfn, cachefn)
+                except (IOError, OSError), exc:
+                    warnings.warn("Could not cache template (%s): %s" % \
+                                  (cachefn, str(exc)), errors.CoastGuardWarning)
+        template_cache[key] = (template, template_phs)
+        return template, template_phs
+
+    def _process_template(self, fn, nchan):
+        """Load the template archive and reduce it to a numpy array.
+
+            Inputs:
+                fn: The template's file name.
+                nchan: The number of channels in the data being cleaned.
+
+            Outputs:
+                template: The template profile(s).
+                template_phs: The frequency-scrunched template (1D).
+        """
+        template_ar = psrchive.Archive_load(fn)
+        template_ar.pscrunch()
+        template_ar.remove_baseline()
+        template_ar.dedisperse()
+        if len(template_ar.get_frequencies()) > 1 and len(template_ar.get_frequencies()) < nchan:
+            print("Template channel number doesn't match data... f-scrunching!")
+            template_ar.fscrunch()
+        template_ar.remove_baseline()
+        template = np.apply_over_axes(np.sum, template_ar.get_data(), (0, 1)).squeeze()
+        # make sure template is 1D
+        if len(np.shape(template)) > 1:  # sum over frequencies too
+            template_ar.fscrunch()
+            template_phs = np.apply_over_axes(np.sum, template_ar.get_data(), (0, 1)).squeeze()
+        else:
+            template_phs = template
+        return template, template_phs
 
 Cleaner = SurgicalScrubCleaner
@@ -31,7 +31,7 @@ def read_file(fn, required=False):
         if not fn.endswith('.cfg'):
             raise ValueError("Coast Guard configuration files must "
                              "end with the extention '.cfg'.")
-        key = os.path.split(fn)[-1][:-4]
+        key = os.path.basename(fn)[:-4]
         execfile(fn, {}, cfgdict)
     elif required:
             raise ValueError("Configuration file (%s) doesn't exist "
@@ -47,6 +47,9 @@ class CoastGuardConfigs(object):
         self.defaults = read_file(default_config_fn, required=True)
         self.obsconfigs = ConfigDict()
         self.overrides = ConfigDict()
+        # Observation configurations already read, keyed by
+        # (telescope, receiver, backend)
+        self.obsconfigs_cache = {}
 
     def __getattr__(self, key):
         return self.__getitem__(key)
@@ -107,6 +110,13 @@ class CoastGuardConfigs(object):
                       arfn['rcvr'].lower(),
                       arfn['backend'].lower()]
         
+        # The configuration files only depend on the precedence list,
+        # so each combination is only read once
+        key = tuple(precedence)
+        if key in self.obsconfigs_cache:
+            self.obsconfigs = copy.deepcopy(self.obsconfigs_cache[key])
+            return
+
         cfgdir = self.base_config_dir
         for dirname in precedence:
             cfgdir = os.path.join(cfgdir, dirname)
@@ -127,6 +137,7 @@ class CoastGuardConfigs(object):
         
         for fn in config_files:
             self.obsconfigs += read_file(fn)
+        self.obsconfigs_cache[key] = copy.deepcopy(self.obsconfigs)
 
 
 class ConfigManager(object):
@@ -13,12 +13,12 @@ import optparse
 import sys
 import subprocess
 import types
-import inspect
 import datetime
 import argparse
 import string
 import tempfile
 import stat
+import shutil
 
 import numpy as np
 
@@ -237,10 +237,16 @@ jname_cache = {}
 prefname_cache = {}
 # A cache for version IDs
 versionid_cache = {}
+# Directories known to exist
+existing_dirs = set()
+# A cache for archive header values, keyed by (filename, mtime, size)
+header_cache = {}
 # A cache for fluxcal names
 __fluxcals = None
 # A cache for psrchive configurations
 __psrchive_configs = None
+# A cache for the (CoastGuard, PSRCHIVE) git hashes
+__githashes = None
 
 def get_psrchive_configs():
     global __psrchive_configs
@@ -346,6 +352,26 @@ def set_warning_mode(mode=None, reset=True):
     warnings.simplefilter(mode)
 
 
+def get_caller_info(depth=2):
+    """Get the location of a calling function without building
+        the full stack (and reading source files) like
+        inspect.stack() does.
+
+        Input:
+            depth: How many frames up the stack to look.
+                (Default: 2 - i.e. the caller of the function
+                calling get_caller_info())
+
+        Outputs:
+            fn: The base name of the caller's source file.
+            lineno: The line number being executed by the caller.
+            funcnm: The name of the calling function.
+    """
+    frame = sys._getframe(depth)
+    return os.path.basename(frame.f_code.co_filename), frame.f_lineno, \
+                frame.f_code.co_name
+
+
 def log_message(msg, level='info'):
     """Log a message
 
@@ -357,9 +383,9 @@ def log_message(msg, level='info'):
         Outputs:
             None
     """
-    fn, lineno, funcnm = inspect.stack()[1][1:4]
+    fn, lineno, funcnm = get_caller_info()
     log.log("Log message: [%s:%d - %s(...)]\n%s" % \
-            (os.path.split(fn)[-1], lineno, funcnm, msg), level)
+            (fn, lineno, funcnm, msg), level)
 
 
 def print_info(msg, level=1):
@@ -376,16 +402,18 @@ def print_info(msg, level=1):
         Outputs:
             None
     """
-    fn, lineno, funcnm = inspect.stack()[1][1:4]
+    if config.log_verbosity < level and config.verbosity < level:
+        return
+    fn, lineno, funcnm = get_caller_info()
     if config.log_verbosity >= level:
         log.log("verbosity: %d [%s:%d - %s(...)]\n%s" % \
-                (level, os.path.split(fn)[-1], lineno, funcnm, msg), 'info')
+                (level, fn, lineno, funcnm, msg), 'info')
 
     if config.verbosity >= level:
         if config.excessive_verbosity:
             # Get caller info
             colour.cprint("INFO (level: %d) [%s:%d - %s(...)]:" % 
-                    (level, os.path.split(fn)[-1], lineno, funcnm), 'infohdr')
+                    (level, fn, lineno, funcnm), 'infohdr')
             msg = msg.replace('\n', '\n    ')
             colour.cprint("    %s" % msg, 'info')
         else:
@@ -464,25 +492,24 @@ def normalise_parfile(par):
     return tmpfn
 
 
-def get_md5sum(fn, block_size=16*8192):
+def get_md5sum(fn, block_size=1<<20):
     """Compute and return the MD5 sum for the given file.
         The file is read in blocks of 'block_size' bytes.
 
         Inputs:
             fn: The name of the file to get the md5 for.
             block_size: The number of bytes to read at a time.
-                (Default: 16*8192)
+                (Default: 1 MiB)
 
         Output:
             md5: The hexidecimal string of the MD5 checksum.
     """
-    f = open(fn, 'rb')
     md5 = hashlib.md5()
-    block = f.read(block_size)
-    while block:
-        md5.update(block)
+    with open(fn, 'rb') as f:
         block = f.read(block_size)
-    f.close()
+        while block:
+            md5.update(block)
+            block = f.read(block_size)
     return md5.hexdigest()
 
 
@@ -497,22 +524,7 @@ def get_version_id(db):
             version_id: The version ID for the current pipeline/psrchive
                 combination.
     """
-    # Check to make sure the repositories are clean
-    is_gitrepo_dirty(config.coastguard_repo)
-    is_gitrepo_dirty(config.psrchive_repo)
-    # Get git hashes
-    coastguard_githash = get_githash(config.coastguard_repo)
-    if is_gitrepo(config.psrchive_repo):
-        psrchive_githash = get_githash(config.psrchive_repo)
-    else:
-        warnings.warn("PSRCHIVE directory (%s) is not a git repository! " \
-                        "Falling back to 'psrchive --version' for version " \
-                        "information." % config.psrchive_repo, \
-                        errors.CoastGuardWarning)
-        cmd = ["psrchive", "--version"]
-        stdout, stderr = execute(cmd)
-        psrchive_githash = stdout.strip()
-  
+    coastguard_githash, psrchive_githash = get_githashes()
     if (coastguard_githash, psrchive_githash) in versionid_cache:
         version_id = versionid_cache[(coastguard_githash, psrchive_githash)]
     else:
@@ -555,6 +567,41 @@ def get_version_id(db):
     return version_id
 
 
+def get_githashes():
+    """Get the git hashes of the CoastGuard and PSRCHIVE
+        repositories. The hashes can't change while the
+        pipeline is running, so they are only determined
+        once per process.
+
+        Inputs:
+            None
+
+        Outputs:
+            coastguard_githash: The CoastGuard git hash.
+            psrchive_githash: The PSRCHIVE git hash (or version
+                string if PSRCHIVE isn't a git repository).
+    """
+    global __githashes
+    if __githashes is None:
+        # Check to make sure the repositories are clean
+        is_gitrepo_dirty(config.coastguard_repo)
+        is_gitrepo_dirty(config.psrchive_repo)
+        # Get git hashes
+        coastguard_githash = get_githash(config.coastguard_repo)
+        if is_gitrepo(config.psrchive_repo):
+            psrchive_githash = get_githash(config.psrchive_repo)
+        else:
+            warnings.warn("PSRCHIVE directory (%s) is not a git repository! " \
+                            "Falling back to 'psrchive --version' for version " \
+                            "information." % config.psrchive_repo, \
+                            errors.CoastGuardWarning)
+            cmd = ["psrchive", "--version"]
+            stdout, stderr = execute(cmd)
+            psrchive_githash = stdout.strip()
+        __githashes = (coastguard_githash, psrchive_githash)
+    return __githashes
+
+
 def get_githash(repodir=None):
     """Get the git hash of a repository.
 
@@ -587,8 +634,7 @@ def is_gitrepo(repodir):
     print_info("Checking if directory '%s' contains a Git repo..." % repodir, 2)
     try:
         cmd = ["git", "rev-parse"]
-        stdout, stderr = execute(cmd, dir=repodir, \
-                                    stderr=open(os.devnull))
+        stdout, stderr = execute(cmd, dir=repodir, stderr=None)
     except errors.SystemCallError:
         # Exit code is non-zero
         return False
@@ -872,7 +918,7 @@ def group_subbands(infns):
             groups: A list of tuples, each being a group of subband
                 files to combine.
     """
-    get_basenm = lambda arf: os.path.splitext(os.path.split(arf.fn)[-1])[0]
+    get_basenm = lambda arf: os.path.splitext(os.path.basename(arf.fn))[0]
     basenms = set([get_basenm(infn) for infn in infns])
 
     groups = []
@@ -1276,6 +1322,51 @@ def sort_by_keys(tosort, keys):
             tosort.sort(key=lambda x: x[sortkey], reverse=rev)
 
 
+def ensure_dir(path):
+    """Make sure a directory exists, creating it (and its parents)
+        if necessary. Directories already seen by this process
+        are not checked again.
+
+        Input:
+            path: The directory's path.
+
+        Outputs:
+            None
+    """
+    if path in existing_dirs:
+        return
+    # Check first, so the common (already exists) case doesn't
+    # go through makedirs' exception
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another process may have created it in the meantime
+            if not os.path.isdir(path):
+                raise
+    existing_dirs.add(path)
+
+
+def copy_file(src, dst):
+    """Copy a file, and its permission bits, like shutil.copy.
+
+        Inputs:
+            src: The file to copy.
+            dst: The destination file name, or a directory to
+                copy the file into.
+
+        Output:
+            dst: The name of the copy.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise errors.InputError("Cannot copy a file onto itself (%s)!" % src)
+    shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+    return dst
+
+
 PERMS = {"w": stat.S_IWGRP,
          "r": stat.S_IRGRP,
          "x": stat.S_IXGRP}
@@ -1294,19 +1385,24 @@ class ArchiveFile(object):
             raise errors.BadFile("Archive file could not be found (%s)!" % \
                                  self.fn)
         
-        self.hdr = get_header_vals(self.fn, ['freq', 'length', 'bw', 'mjd', 
+        # Only run 'vap' if this version of the file hasn't been seen
+        st = os.stat(self.fn)
+        key = (self.fn, st.st_mtime, st.st_size)
+        if key not in header_cache:
+            header_cache[key] = get_header_vals(self.fn, ['freq', 'length', 'bw', 'mjd', 
                                             'intmjd', 'fracmjd', 'backend', 
                                             'rcvr', 'telescop', 'name', 
                                             'nchan', 'period', 'dm',
                                             'nsub', 'nbin', 'npol',
                                             'ra', 'dec'])
+        self.hdr = dict(header_cache[key])
         self.hdr['origname'] = self.hdr['name'] # Original file name
         self.hdr['name'] = get_prefname(self.hdr['name']) # Use preferred name
         self.hdr['secs'] = int(self.hdr['fracmjd']*24*3600+0.5) # Add 0.5 so we actually round
         self.datetime = mjd_to_datetime(self.hdr['mjd'])
         self.hdr['yyyymmdd'] = self.datetime.strftime("%Y%m%d")
         self.hdr['pms'] = self.hdr['period']*1000.0
-        self.hdr['inputfn'] = os.path.split(self.fn)[-1]
+        self.hdr['inputfn'] = os.path.basename(self.fn)
         self.hdr['inputbasenm'] = os.path.splitext(self.hdr['inputfn'])[0]
         self.hdr['telname'] = site_to_telescope[self.hdr['telescop'].lower()]
         if self.hdr['freq'] < 1000: